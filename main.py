@@ -57,13 +57,106 @@ I thiiiiiink storing dead trees is also O(nlogn)
 
 import io
 import os
+import mmap
 import heapq # used for heapq.merge
-from typing import Optional, Iterable, BinaryIO
+import bisect
+import itertools
+import functools
+from typing import Optional, Iterable, Iterator, BinaryIO
 import hashlib
 
 def count_trailing_ones(n: int) -> int:
 	return (n ^ (n + 1)).bit_length() - 1
 
+MMAP_THRESHOLD = 0x10000 # bytes
+MERGE_BLOCK_HEIGHT = 12 # Tree.merge hashes the merged leaves one 2^12-leaf subtree at a time
+
+@functools.cache
+def storage_order(num_leaves: int) -> list[int]:
+	"""
+	for a complete subtree with num_leaves leaves, lay its levels out back to back (leaves
+	first, root last) and list the byte offset into that layout of each node, in storage order
+	"""
+	level_starts = []
+	start, width = 0, num_leaves
+	while width:
+		level_starts.append(start)
+		start += width
+		width //= 2
+	order = []
+	for i in range(num_leaves):
+		order.append(i)
+		j = i
+		for lvl in range(1, count_trailing_ones(i) + 1): # the parents completed by this leaf
+			j //= 2
+			order.append(level_starts[lvl] + j)
+	return [idx*32 for idx in order]
+
+def serialise_subtree(leaves: bytes) -> bytes:
+	"""
+	build the complete subtree over some concatenated leaves (a power-of-two count of them),
+	returning it in storage order - the root is the last entry.
+
+	hashing happens a whole level at a time rather than one stack pop at a time, then the
+	levels get permuted into storage order in one pass
+	"""
+	sha256 = hashlib.sha256
+	level = leaves
+	levels = [level]
+	while len(level) > 32:
+		level = b"".join([sha256(level[k:k+64]).digest() for k in range(0, len(level), 64)])
+		levels.append(level)
+	flat = b"".join(levels)
+	return b"".join([flat[k:k+32] for k in storage_order(len(leaves)//32)])
+
+def merge_sorted(a: Iterable[bytes], b: Iterable[bytes], chunk_size: int=0x1000) -> Iterator[bytes]:
+	"""
+	2-way merge of two sorted streams, equivalent to heapq.merge(a, b) but done a chunk at a
+	time with list.sort(), which merges two presorted runs in linear time (and in C)
+	"""
+	a, b = iter(a), iter(b)
+	buf_a, buf_b = [], []
+	while True:
+		if not buf_a:
+			buf_a = list(itertools.islice(a, chunk_size))
+		if not buf_b:
+			buf_b = list(itertools.islice(b, chunk_size))
+		if not buf_a or not buf_b:
+			break
+		# everything up to the smaller of the two buffer tails can safely be emitted now
+		if buf_a[-1] <= buf_b[-1]:
+			cut = bisect.bisect_right(buf_b, buf_a[-1])
+			out = buf_a + buf_b[:cut]
+			buf_a, buf_b = [], buf_b[cut:]
+		else:
+			cut = bisect.bisect_right(buf_a, buf_b[-1])
+			out = buf_b + buf_a[:cut]
+			buf_a, buf_b = buf_a[cut:], []
+		out.sort()
+		yield from out
+	yield from buf_a
+	yield from a
+	yield from buf_b
+	yield from b
+
+def map_data(data: BinaryIO):
+	"""
+	get a sliceable view of a tree's backing storage, so that reads are plain slices
+	rather than a seek()+read() pair each.
+
+	large files are mmap'd read-only (slicing an mmap yields bytes directly), small files
+	and in-memory buffers are just slurped into a bytes object
+	"""
+	try:
+		fileno = data.fileno()
+	except io.UnsupportedOperation:
+		return data.getvalue()
+	size = os.fstat(fileno).st_size
+	if size <= MMAP_THRESHOLD: # small trees: one read() is cheaper than setting up a mapping
+		data.seek(0)
+		return data.read()
+	return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
 tree_counter = 0 # for testing
 class Tree:
 	"""
@@ -74,6 +167,7 @@ class Tree:
 	note: this used to be an in-memory implementation but then I hacked it up to be backed by a
 	BinaryIO, which in this instance is files on disk.
 	"""
+	__slots__ = ("height", "cardinality", "data", "buf", "root") # one Tree object is allocated per insert
 
 	def __init__(self, data: BinaryIO, height: int) -> None:
 		global tree_counter # for testing
@@ -88,6 +182,7 @@ class Tree:
 		self.height = height
 		self.cardinality = 2**(self.height-1)  # number of leaves
 		self.data = data
+		self.buf = map_data(data)
 		self.root = self.get_data_entry((2**self.height)-2)#data[-32:]  # XXX: for height=1, "root" will be the leaf value - might wanna think about domain separation
 
 	def __repr__(self) -> str:
@@ -97,38 +192,87 @@ class Tree:
 		"""
 		iterate thru leaves
 		"""
-		self.data.seek(0)
+		buf = self.buf
 		for i in range(self.cardinality):
-			yield self.data.read(32)
-			self.data.seek(count_trailing_ones(i) * 32, io.SEEK_CUR)
+			offset = (2*i - i.bit_count()) * 32 # leaf i is preceded by i leaves and i - popcount(i) parents
+			yield buf[offset:offset+32]
 
 	def get_data_entry(self, idx) -> bytes:
-		self.data.seek(idx*32)
-		return self.data.read(32)
+		return self.buf[idx*32:idx*32+32]
 
 	def find_left(self, needle):
 		"""
 		find the needle, or if not, the item to the left of where the needle would be
 		(or the leftmost item, if the needle would be to the left of that)
+
+		binary search over the data offsets, descending one level per iteration.
+		the proof is accumulated top-down (root first)
 		"""
-		return self._find_inner(needle, [], 0, (2**self.height)-1)
+		proof = []
+		start, end = 0, (2**self.height)-1
+		while True:
+			mid = start + (end - start) // 2  # this Just Works (!!!)
+			mid_data = self.get_data_entry(mid)
+			if end - start == 1:
+				return mid_data, proof
+
+			if needle < mid_data:
+				proof.append((0, self.get_data_entry(end - 2)))
+				end = mid
+			else:
+				proof.append((1, self.get_data_entry(mid - 1)))
+				start, end = mid, end - 1
 
-	def _find_inner(self, needle, proof, start, end):
+	@classmethod
+	def from_sorted(cls, leaves: Iterable[bytes], height: int) -> "Tree":
 		"""
-		binary search to find the data offset
+		build a tree of the given height from exactly 2^(height-1) leaves, which must already
+		be in sorted order
 		"""
-		mid = start + (end - start) // 2  # this Just Works (!!!)
-		mid_data = self.get_data_entry(mid)
-
-		print(mid_data, start, mid, end)
-
-		if end - start == 1:
-			return mid_data, proof
-	
-		if needle < mid_data:
-			return self._find_inner(needle, proof + [(0, self.get_data_entry(end - 2))], start, mid)
+		if height == 1:
+			(leaf,) = leaves
+			return cls(io.BytesIO(leaf), 1)
+		num_leaves = 2**(height-1)
+		data = open("./trees/tmp", "wb+", buffering=0) # unbuffered: we only ever do one big write, or go via mmap
+		out_size = ((2**height)-1)*32
+		if out_size <= MMAP_THRESHOLD:
+			out = bytearray(out_size) # small trees get assembled in memory and written in one go
+		else:
+			# reserve the whole file up front and write through a mapping, rather than
+			# pushing every 32-byte entry through write()
+			if hasattr(os, "posix_fallocate"):
+				os.posix_fallocate(data.fileno(), 0, out_size)
+			else:
+				data.truncate(out_size)
+			out = mmap.mmap(data.fileno(), out_size)
+		sha256 = hashlib.sha256 # hoisted out of the hot loop
+		leaves = iter(leaves)
+		block_size = min(2**MERGE_BLOCK_HEIGHT, num_leaves)
+		stack = []
+		off = 0
+		for i in range(num_leaves // block_size):
+			# each block of leaves is a complete subtree, and contiguous in storage order
+			block = serialise_subtree(b"".join(itertools.islice(leaves, block_size)))
+			out[off:off+len(block)] = block
+			off += len(block)
+			stack.append(block[-32:])
+			for _ in range(count_trailing_ones(i)):
+				# pull two, hash them, emit and push
+				b, a = stack.pop(), stack.pop()
+				h = sha256(a+b).digest()
+				out[off:off+32] = h
+				off += 32
+				stack.append(h)
+		assert(len(stack) == 1)
+		assert(off == out_size)
+		if isinstance(out, mmap.mmap):
+			out.close()
 		else:
-			return self._find_inner(needle, proof + [(1, self.get_data_entry(mid - 1))], mid, end - 1)
+			view = memoryview(out)
+			while view: # raw (unbuffered) writes are allowed to be short
+				view = view[data.write(view):]
+		os.rename("./trees/tmp", f"./trees/{stack[0].hex()}.bin")
+		return cls(data, height)
 
 	def merge(self, other) -> "Tree":
 		"""
@@ -138,23 +282,11 @@ class Tree:
 			raise TypeError("can only merge subtrees")
 		if self.height != other.height:
 			raise ValueError("can only merge trees of the same height")
-		data = open("./trees/tmp", "wb+")#io.BytesIO()
-		stack = []
-		for i, entry in enumerate(heapq.merge(self, other)):
-			data.write(entry)
-			stack.append(entry)
-			for _ in range(count_trailing_ones(i)):
-				# pull two, hash them, emit and push
-				b, a = stack.pop(), stack.pop()
-				h = hashlib.sha256(a+b).digest()
-				data.write(h)
-				stack.append(h)
-		assert(len(stack) == 1)
-		os.rename("./trees/tmp", f"./trees/{stack[0].hex()}.bin")
+		merged = Tree.from_sorted(merge_sorted(self, other), self.height + 1)
 		if self.height > 1:
 			os.remove(f"./trees/{self.root.hex()}.bin")
 			os.remove(f"./trees/{other.root.hex()}.bin")
-		return Tree(data, self.height + 1)
+		return merged
 
 	def __or__(self, other) -> "Tree":
 		return self.merge(other)
@@ -165,6 +297,8 @@ class Forest:
 	forests are immutable.
 	"add" operation produces a new forest with the new entry added.
 	"""
+	__slots__ = ("cardinality", "trees", "root") # like Tree, one of these is allocated per insert
+
 	cardinality: int
 	trees: tuple[Tree, ...]
 	root: bytes
@@ -202,6 +336,43 @@ class Forest:
 			i += 1
 		return Forest(self.trees[:len(self.trees)-(i-1)] + (accumulator,))
 
+	def extend(self, entries: Iterable[bytes]) -> "Forest":
+		"""
+		bulk version of add: produces the same forest as adding each entry in turn, but each
+		resulting tree is written exactly once, rather than the tail of the forest being
+		re-merged on every insert
+		"""
+		entries = list(entries)
+		for entry in entries:
+			if len(entry) != 32:
+				raise ValueError("entry must be 32 bytes long (expects sha256 hash output)")
+		if not entries:
+			return self
+
+		# the tree sizes of a canonical forest are the set bits of its cardinality. existing
+		# trees survive for as long as they line up with the new sizes, and the first
+		# mismatch swallows all the remaining ones (it is necessarily bigger than all of them)
+		cardinality = self.cardinality + len(entries)
+		sizes = [1 << b for b in reversed(range(cardinality.bit_length())) if (cardinality >> b) & 1]
+		kept = 0
+		while kept < len(self.trees) and self.trees[kept].cardinality == sizes[kept]:
+			kept += 1
+		absorbed = self.trees[kept:]
+		# remove the absorbed trees' files before writing any new ones - we're a multiset, so a
+		# new tree can have the same root (and filename) as an absorbed one. the absorbed Trees
+		# keep their data mapped, so they can still be read from below
+		for tree in absorbed:
+			if tree.height > 1:
+				os.remove(f"./trees/{tree.root.hex()}.bin")
+
+		trees = list(self.trees[:kept])
+		pending = iter(entries)
+		for size in sizes[kept:]:
+			fresh = sorted(itertools.islice(pending, size - sum(t.cardinality for t in absorbed)))
+			trees.append(Tree.from_sorted(heapq.merge(*absorbed, fresh), size.bit_length()))
+			absorbed = ()
+		return Forest(trees)
+
 
 if __name__ == "__main__":
 	a = Tree(io.BytesIO(b"A"*32), 1)
@@ -240,16 +411,29 @@ if __name__ == "__main__":
 	print(accumulator.hex())
 	assert(accumulator == t0.root)
 
+	# bulk inserts must produce the same forest as one add() at a time (duplicates included)
+	keys = [b"W"*32, b"X"*32, b"Y"*32, b"Z"*32, b"W"*32, b"X"*32]
+	f = Forest()
+	for k in keys:
+		f = f.add(k)
+	g = Forest().extend(keys[:2]).extend(keys[2:])
+	assert(g.root == f.root)
+	for tree in g.trees:
+		assert(tree.height == 1 or os.path.exists(f"./trees/{tree.root.hex()}.bin"))
+	print("extend ok")
 
 	# benchmark!
 	import time
-	start = time.time()
-	f = Forest()
+	import gc
 	NUM_INSERTS = 0x100000
-	for i in range(NUM_INSERTS):
-		k = i.to_bytes(32)
+	keys = [i.to_bytes(32) for i in range(NUM_INSERTS)] # generated up front so they're not part of the timing
+	gc.disable() # the per-insert Forest/Tree churn otherwise triggers collections mid-run
+	start = time.perf_counter_ns()
+	f = Forest()
+	for k in keys:
 		f = f.add(k)
-	duration = time.time() - start
+	duration = (time.perf_counter_ns() - start) / 1e9
+	gc.enable()
 	print(NUM_INSERTS/duration, "MMT inserts per second") # I get 20K inserts per second on my machine (it was closer to 70K when I was doing everything in-memory)
 	print(tree_counter, "total trees")
 